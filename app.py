@@ -1,13 +1,13 @@
 import streamlit as st
 import pandas as pd
-from fredapi import Fred
-import yfinance as yf
+import requests
 import numpy as np
 from datetime import datetime, timedelta
-import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
-from scipy.stats import norm
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import tempfile
+import time
 
 # --- 1. 頁面設定 ---
 st.set_page_config(page_title="Alpha 宏觀戰情室 Pro (Interactive)", layout="wide")
@@ -15,137 +15,420 @@ st.title("🦅 Alpha 宏觀戰情室 Pro (Interactive)")
 st.markdown("監控全球資金水位、市場估值與信貸週期的核心儀表板")
 
 # --- 2. 側邊欄：設定 ---
+# 選單文字 -> (yfinance 代號, 圖例名稱)，啟動時建好一次
+TICKERS = {
+    "^GSPC (S&P 500 - 七巨頭)": ("^GSPC", "S&P 500"),
+    "RSP (S&P 500 等權重 - 真實經濟)": ("RSP", "S&P 500 EW"),
+    "^NDX (Nasdaq 100)": ("^NDX", "Nasdaq 100"),
+    "^SOX (費半)": ("^SOX", "SOX"),
+    "BTC-USD (比特幣)": ("BTC-USD", "Bitcoin"),
+}
+
+MIN_START_YEAR = 2000  # 側邊欄最早可選的起始年
+WARMUP_YEARS = 2  # 起始年再往前抓的年數，供 ffill 與 rolling 暖身
+# 股價固定抓到最早可能用到的日期，與滑桿脫鉤：移動滑桿只在本地切片，不會重新下載
+STOCK_HISTORY_START = f"{MIN_START_YEAR - WARMUP_YEARS}-01-01"
+
 with st.sidebar:
     st.header("⚙️ 參數設定")
     api_key_input = st.text_input("輸入 FRED API Key", type="password")
     st.divider()
     st.subheader("📈 股市對比")
-    compare_index = st.selectbox(
-        "選擇指數",
-        ["^GSPC (S&P 500 - 七巨頭)", "RSP (S&P 500 等權重 - 真實經濟)", "^NDX (Nasdaq 100)", "^SOX (費半)", "BTC-USD (比特幣)"]
-    )
+    compare_index = st.selectbox("選擇指數", list(TICKERS))
+    symbol, symbol_label = TICKERS[compare_index]
     st.subheader("🗓️ 時間軸設定")
-    display_start_year = st.slider("圖表顯示起始年", 2000, 2026, 2018)
+    display_start_year = st.slider("圖表顯示起始年", MIN_START_YEAR, 2026, 2018)
     st.subheader("🧮 模型訓練區間")
     reg_start_year = st.slider("回歸模型訓練起始年", 2010, 2025, 2020)
-    data_fetch_days = 365 * 30 
+    # FRED 只抓到較早的起始年再往前 WARMUP_YEARS 年，不必每次都抓 30 年
+    data_fetch_days = (datetime.now().year - min(display_start_year, reg_start_year) + WARMUP_YEARS) * 365
     st.markdown("---")
     st.markdown("[申請 FRED API Key](https://fred.stlouisfed.org/docs/api/api_key.html)")
 
 # --- 3. 數據核心 ---
-@st.cache_data(ttl=3600)
-def get_macro_data(api_key, days):
-    fred = Fred(api_key=api_key)
-    start_date = datetime.now() - timedelta(days=days)
+# 欄位名稱 -> FRED series id
+FRED_SERIES = {
+    'Fed_Assets': 'WALCL', 'TGA': 'WTREGEN', 'RRP': 'RRPONTSYD',
+    'Yield_Curve': 'T10Y3M', 'T3M': 'DGS3MO', 'RRP_Rate': 'RRPONTSYAWARD',
+    'HY_Spread': 'BAMLH0A0HYM2', 'Delinq_Consumer': 'DRCCLACBS'
+}
+
+FRED_OBSERVATIONS_URL = "https://api.stlouisfed.org/fred/series/observations"
+
+@st.cache_resource(show_spinner=False)
+def get_fred_session():
+    # 共用一個連線池：TLS 連線在各 series 與各次 rerun 間重複使用
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip'
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=len(FRED_SERIES)))
+    return session
+
+def fetch_fred_series(session, api_key, series_id, start_date, end_date=None):
+    # api_key 在 query string 裡：requests 的例外訊息會帶完整 URL，只回報例外類型，避免把 key 顯示在頁面上
+    try:
+        resp = session.get(FRED_OBSERVATIONS_URL, params={
+            'series_id': series_id, 'api_key': api_key, 'file_type': 'json',
+            'observation_start': start_date.strftime('%Y-%m-%d'),
+            **({'observation_end': end_date.strftime('%Y-%m-%d')} if end_date is not None else {})
+        }, timeout=30)
+    except requests.RequestException as e:
+        raise ValueError(f"連線失敗 ({type(e).__name__})") from None
+    if not resp.ok:
+        # 閘道錯誤等情況回的是 HTML 而不是 JSON，改用 HTTP 狀態碼
+        try:
+            message = resp.json().get('error_message', resp.reason)
+        except ValueError:
+            message = resp.reason
+        raise ValueError(f"HTTP {resp.status_code} {message}")
+    obs = resp.json()['observations']
+    # FRED 以 "." 表示缺值
+    values = pd.to_numeric(pd.Series([o['value'] for o in obs]), errors='coerce').to_numpy()
+    return pd.Series(values, index=pd.to_datetime([o['date'] for o in obs]), name=series_id)
+
+def fetch_fred_frame(api_key, starts, base=None, end=None):
+    """starts: 欄位 -> 起始日，end: 可選的共同結束日。給 base 時抓回的區段取代 base 各欄在 [start, end] 內的資料"""
+    session = get_fred_session()
+    # 各 series 互相獨立，平行發出 HTTP 請求
+    with ThreadPoolExecutor(max_workers=len(FRED_SERIES)) as ex:
+        futures = {name: ex.submit(fetch_fred_series, session, api_key, sid, starts[name], end) for name, sid in FRED_SERIES.items()}
+        series, failed = {}, []
+        for name, f in futures.items():
+            # 逐一收集錯誤，一次回報所有失敗的 series，而不是只看到第一個
+            try:
+                series[name] = f.result()
+            except Exception as e:
+                failed.append(f"{FRED_SERIES[name]}: {e}")
+    if failed:
+        raise ValueError("; ".join(failed))
+    if base is not None:
+        # 逐欄拼接：各 series 的重抓起點不同，base 裡的 NaN 只是 index 聯集造成的空位
+        def outside(name):
+            keep = base.index < starts[name]
+            return keep | (base.index > end) if end is not None else keep
+        series = {name: pd.concat([base[name][outside(name)].dropna(), s]).sort_index() for name, s in series.items()}
+    series['RRP'] = series['RRP'].fillna(0)
+    series['RRP_Rate'] = series['RRP_Rate'].fillna(0)
+    # float32 對宏觀數據精度足夠，ffill/dropna 搬動的 bytes 減半
+    # 一次 concat 完成所有 series 的 index 對齊 (dict key 即欄位名)
+    return pd.concat(series, axis=1, sort=True).astype('float32')
+
+# 磁碟快取：Streamlit 重啟後仍可沿用，之後只增量抓最近一段
+CACHE_DIR = Path(__file__).parent / ".cache"
+FRED_REFETCH_DAYS = 30  # 增量更新時從各 series 最後一筆往回重抓的天數，涵蓋 FRED 的近期修正
+# 季資料以季初日期標示、約 5 個月後才公布，之後還會修正：往回抓一年以上才不會漏掉
+FRED_REFETCH_OVERRIDE = {'Delinq_Consumer': 400}
+FRED_CACHE_TTL = 3600  # 磁碟快取在此時間內視為最新，連增量請求都省掉
+
+def cache_path(prefix, key):
+    # 用 sha256 而非 hash()：後者每個 process 都不同，且避免 API key 明文出現在檔名
+    return CACHE_DIR / f"{prefix}_{hashlib.sha256(key.encode()).hexdigest()[:16]}.parquet"
+
+def read_parquet_cache(path):
     try:
-        # 1. 抓取原始數據
-        fed_assets = fred.get_series('WALCL', observation_start=start_date)
-        tga = fred.get_series('WTREGEN', observation_start=start_date)
-        rrp = fred.get_series('RRPONTSYD', observation_start=start_date).fillna(0)
-        yc_10y3m = fred.get_series('T10Y3M', observation_start=start_date)
-        t3m = fred.get_series('DGS3MO', observation_start=start_date)
-        rrp_rate = fred.get_series('RRPONTSYAWARD', observation_start=start_date).fillna(0)
-        hy_spread = fred.get_series('BAMLH0A0HYM2', observation_start=start_date)
-        delinq_consumer = fred.get_series('DRCCLACBS', observation_start=start_date)
-
-        df = pd.DataFrame({
-            'Fed_Assets': fed_assets, 'TGA': tga, 'RRP': rrp,
-            'Yield_Curve': yc_10y3m, 'T3M': t3m, 'RRP_Rate': rrp_rate,
-            'HY_Spread': hy_spread, 'Delinq_Consumer': delinq_consumer
-        }).fillna(method='ffill').dropna()
-
-        # 🟢 單位校準：統一轉為 Trillions (兆美元)
-        df['Net_Liquidity'] = (df['Fed_Assets'] / 1000000) - (df['TGA'] / 1000000) - (df['RRP'] / 1000)
-        df['Arb_Spread'] = df['T3M'] - df['RRP_Rate']
-        return df
-    except Exception as e:
-        st.error(f"數據抓取錯誤: {e}"); return None
-
-def get_stock_data(ticker, start_date):
-    symbol = ticker.split(" ")[0]
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+def cache_is_fresh(path, ttl):
+    return path.exists() and time.time() - path.stat().st_mtime < ttl
+
+def write_parquet_cache(df, path):
+    CACHE_DIR.mkdir(exist_ok=True)
+    # 每次寫入用獨立的暫存檔名：同時有多個快取未命中時，不會 replace 到別人寫了一半的檔案
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+        tmp = Path(f.name)
     try:
-        df_stock = yf.download(symbol, start=start_date, progress=False)
-        if df_stock.empty: return None
-        if isinstance(df_stock.columns, pd.MultiIndex): 
-            df_stock.columns = df_stock.columns.get_level_values(0)
-        stock = df_stock['Close']
+        df.to_parquet(tmp, compression='zstd')
+        tmp.replace(path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+@st.cache_data(ttl=FRED_CACHE_TTL, show_spinner=False)
+def get_macro_data(api_key, days):
+    # 取整到日：同一天內每次快取未命中都得到相同的起始日，FRED 請求與切片結果一致
+    start_date = datetime.combine(datetime.now().date() - timedelta(days=days), datetime.min.time())
+    # 回傳 (df, 警告)。沒有可用的快取時失敗一律 raise：st.cache_data 不快取例外，暫時性的斷線/5xx 不會被記住一整個 TTL
+    # 1. 抓取原始數據：磁碟快取未過 FRED_CACHE_TTL 直接沿用，否則每個 series 從自己的最後一筆往回重抓
+    #    (日資料與季資料的最新日期差好幾個月)；所需區間早於快取起點時只補抓前段
+    path = cache_path('fred', api_key)
+    raw = read_parquet_cache(path)
+    warning = None
+    if raw is not None and set(raw.columns) == set(FRED_SERIES):
+        stale, changed = not cache_is_fresh(path, FRED_CACHE_TTL), False
+        if raw.index.min() > start_date + timedelta(days=7):
+            # 滑桿往前移：只補抓快取起點之前缺的那一段，接在快取前面，不必整份重抓
+            head_end = raw.index.min() - timedelta(days=1)
+            raw = fetch_fred_frame(api_key, dict.fromkeys(FRED_SERIES, start_date), base=raw, end=head_end)
+            changed = True
+        if stale:
+            starts = {}
+            for name in FRED_SERIES:
+                last = raw[name].last_valid_index()
+                starts[name] = start_date if last is None else last - timedelta(days=FRED_REFETCH_OVERRIDE.get(name, FRED_REFETCH_DAYS))
+            try:
+                raw = fetch_fred_frame(api_key, starts, base=raw)
+            except Exception as e:
+                # 增量更新失敗時沿用磁碟上的舊資料，不要因為一次斷線就整頁報錯
+                warning = f"FRED 更新失敗，暫用 {raw.index.max():%Y-%m-%d} 為止的快取資料: {e}"
+            else:
+                changed = True
+        # 尾端更新失敗時不寫檔：檔案 mtime 維持舊的，下次未命中會再試
+        if changed and warning is None:
+            write_parquet_cache(raw, path)
+    else:
+        raw = fetch_fred_frame(api_key, dict.fromkeys(FRED_SERIES, start_date))
+        write_parquet_cache(raw, path)
+
+    # raw 由本函式持有且已寫入快取，可直接原地 ffill，少一份整表副本
+    raw.ffill(inplace=True)
+    df = raw[raw.index >= start_date].dropna()
+
+    # 🟢 單位校準：統一轉為 Trillions (兆美元)
+    fed_assets, tga, rrp = df['Fed_Assets'].to_numpy(), df['TGA'].to_numpy(), df['RRP'].to_numpy()
+    df['Net_Liquidity'] = (fed_assets - tga) * 1e-6 - rrp * 1e-3
+    df['Arb_Spread'] = df['T3M'].to_numpy() - df['RRP_Rate'].to_numpy()
+    return df, warning
+
+STOCK_CACHE_KEEP = 7 * 86400  # 超過一週沒更新的股價檔直接清掉
+
+def stock_cache_is_current(path, index):
+    # 以資料日期判斷新舊，而不是檔案 mtime：最後一筆要到上一個交易日，
+    # 且檔案是在那天之後才寫入 (盤中抓到的當日價不算收盤，之後還要重抓)
+    last = index.max()
+    written = pd.Timestamp(datetime.fromtimestamp(path.stat().st_mtime).date())
+    return last >= pd.Timestamp.today().normalize() - pd.offsets.BDay(1) and written > last
+
+# 記憶體快取與 FRED 同步每小時過期，不在磁碟檔之上再疊一天
+@st.cache_data(ttl=FRED_CACHE_TTL, show_spinner=False)
+def get_stock_data(symbol, start_date):
+    # 每個代號只存一份歷史 (attrs 記錄下載起始日)，讀出後依 start_date 切片
+    path = cache_path('yf', symbol)
+    cached = read_parquet_cache(path)
+    if cached is not None and cached.attrs.get('start', '9999') <= start_date and stock_cache_is_current(path, cached.index):
+        return cached['Close'].loc[start_date:]
+    import yfinance as yf  # 延遲載入：只有快取未命中時才需要
+    # 失敗一律 raise：st.cache_data 不快取例外，暫時性的限流/斷線不會被記住一整天
+    # 單一代號 + multi_level_index=False：欄位固定是單層，不必在執行期判斷 MultiIndex
+    df_stock = yf.download(symbol, start=start_date, progress=False, auto_adjust=True, threads=False, multi_level_index=False)
+    if df_stock.empty:
+        raise ValueError(f"{symbol} 沒有回傳任何股價 (可能被限流或網路中斷)")
+    stock = df_stock['Close'].dropna().astype('float32')
+    # 只在有時區時才去掉；用 tz_localize 保留交易所當地日期 (tz_convert 會轉成 UTC 時刻而對不上 FRED 日期)
+    if stock.index.tz is not None:
         stock.index = stock.index.tz_localize(None)
-        return stock
-    except: return None
+    frame = stock.to_frame('Close')
+    frame.attrs['start'] = start_date
+    write_parquet_cache(frame, path)
+    # 久未更新的股價檔一律清掉 (含舊版依起始日命名的檔案)，.cache/ 不會每天多一個檔
+    for old in CACHE_DIR.glob('yf_*.parquet'):
+        if not cache_is_fresh(old, STOCK_CACHE_KEEP):
+            old.unlink(missing_ok=True)
+    return stock
 
-# --- 4. 主邏輯 ---
+def rolling_mean(a, w):
+    """前綴和算移動平均：一次 cumsum，O(n)；前 w-1 筆為 NaN，與 rolling(w).mean() 相同 (輸入不得含 NaN)"""
+    c = np.concatenate(([0.0], np.cumsum(a, dtype=np.float64)))
+    return np.concatenate((np.full(min(w - 1, len(a)), np.nan), (c[w:] - c[:-w]) / w))
+
+def fit_ols(x, y):
+    """一元線性回歸的封閉解：由去均值後的二階動差得到 slope / intercept / R²"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    mx, my = x.mean(), y.mean()
+    # 先去均值再相乘，避免原始平方和相減時的 catastrophic cancellation
+    dx, dy = x - mx, y - my
+    sxx, sxy, syy = dx @ dx, dx @ dy, dy @ dy
+    slope = sxy / sxx
+    return slope, my - slope * mx, sxy * sxy / (sxx * syy)
+
+@st.cache_data(show_spinner=False)
+def fit_fair_value(train_data):
+    """回歸 淨流動性 -> 股價，只以訓練區間為快取 key；樣本不足時回傳 None"""
+    if len(train_data) <= 30:
+        return None
+    # 回歸維持 float64，避免 float32 數值不穩
+    x = train_data['Net_Liquidity_Smooth'].to_numpy(dtype=np.float64)
+    y = train_data['Stock_Price'].to_numpy(dtype=np.float64)
+    return fit_ols(x, y)
+
+# --- 4. 圖表工具 ---
+MAX_PLOT_POINTS = 1000  # 每條曲線送進瀏覽器的點數上限
+CHART_WIDTH = 1200
+# 固定寬度、關閉 responsive：容器尺寸變動或 rerun 時 Plotly.js 不必重新排版
+CHART_CONFIG = {'responsive': False, 'displaylogo': False, 'doubleClick': 'reset'}
+
+# 溢價率長條：以數值 + 二分色階著色 (cmid=0，>0 紅、<0 綠)，不必送出 N 個顏色字串
+DEVIATION_MARKER = dict(colorscale=[[0, 'green'], [0.5, 'green'], [0.5, 'red'], [1, 'red']], cmid=0, showscale=False)
+
+CHART_LAYOUT = dict(template="plotly_dark", width=CHART_WIDTH, autosize=False, xaxis_rangeslider_visible=False)
+
+def show_chart(fig):
+    st.plotly_chart(fig, width="content", config=CHART_CONFIG)
+
+def lttb_downsample(s, n_out=MAX_PLOT_POINTS):
+    """Largest-Triangle-Three-Buckets：保留曲線形狀，把點數壓到 n_out"""
+    s = s.dropna()
+    n = len(s)
+    if n <= n_out or n_out < 3:
+        return s
+    x = (s.index.asi8 - s.index.asi8[0]).astype(np.float64)
+    y = s.to_numpy(dtype=np.float64)
+    # 首尾兩點固定保留，中間切成 n_out - 2 個桶
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:nxt_hi].mean(), y[hi:nxt_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return s.iloc[keep]
+
+def minmax_downsample(s, n_out=MAX_PLOT_POINTS):
+    """每個桶只留最小與最大值 (M4 的 min/max)，長條圖的尖峰不會被平均掉"""
+    s = s.dropna()
+    n = len(s)
+    if n <= n_out:
+        return s
+    k = -(-n // (n_out // 2))  # 每桶點數
+    padded = np.full(-(-n // k) * k, np.nan)
+    padded[:n] = s.to_numpy(dtype=np.float64)
+    blocks = padded.reshape(-1, k)
+    offsets = np.arange(blocks.shape[0]) * k
+    keep = np.unique(np.r_[offsets + np.nanargmin(blocks, axis=1), offsets + np.nanargmax(blocks, axis=1)])
+    return s.iloc[keep]
+
+def lttb_xy(s, scale=1, n_out=MAX_PLOT_POINTS):
+    # 等比例縮放不改變 LTTB 選到的點，所以單位換算放在降採樣之後，只乘 n_out 筆
+    ds = lttb_downsample(s, n_out)
+    return dict(x=ds.index, y=ds.to_numpy() * scale)
+
+# --- 5. 圖表 ---
+# 圖表以 cache_resource 依輸入資料快取：命中時省下 LTTB 降採樣與建構圖表 (每張約 50 ms)，且共用物件不經 pickle。
+# st.plotly_chart 每次渲染仍會整份重新驗證 (約 1.5 ms)，這部分快取省不掉。
+# 回傳的圖表視為唯讀，所有版面設定都在函式內完成。各函式只收需要的欄位，無關的側邊欄變動不會讓快取失效。
+FIGURE_CACHE = dict(ttl=3600, max_entries=64, show_spinner=False)
+
+@st.cache_resource(**FIGURE_CACHE)
+def make_liquidity_fig(liq_df):
+    import plotly.graph_objects as go
+    return go.Figure(data=[
+        go.Scattergl(**lttb_xy(liq_df['Net_Liquidity']), name="Net Liquidity", line=dict(color='#00FF00', width=3)),
+        go.Scattergl(**lttb_xy(liq_df['TGA'], 1e-6), name="TGA (Freezer)", line=dict(color='#FF4136', width=1, dash='dot')),
+        go.Scattergl(**lttb_xy(liq_df['RRP'], 1e-3), name="RRP (Water Tank)", line=dict(color='#FFA500', width=1, dash='dash')),
+    ], layout=dict(height=350, margin=dict(t=20, b=20), hovermode="x unified", **CHART_LAYOUT))
+
+@st.cache_resource(**FIGURE_CACHE)
+def make_valuation_fig(price, fair_value, deviation_pct, price_label):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.7, 0.3])
+    dev = minmax_downsample(deviation_pct)
+    fig.add_traces([
+        go.Scattergl(**lttb_xy(price), name=price_label, line=dict(color='#FFA500')),
+        go.Scattergl(**lttb_xy(fair_value), name="Fair Value", line=dict(color='#1E90FF', dash='dash')),
+        go.Bar(x=dev.index, y=dev.to_numpy(), name="Bubble %", marker=DEVIATION_MARKER | dict(color=dev.to_numpy())),
+    ], rows=[1, 1, 2], cols=[1, 1, 1])
+    fig.update_layout(height=600, hovermode="x unified", **CHART_LAYOUT)
+    return fig
+
+@st.cache_resource(**FIGURE_CACHE)
+def make_yield_curve_fig(yc_df):
+    import plotly.graph_objects as go
+    return go.Figure(data=[
+        go.Scattergl(**lttb_xy(yc_df['Yield_Curve']), name="10Y-3M (Macro)", line=dict(color='#00FFFF')),
+        go.Scattergl(**lttb_xy(yc_df['Arb_Spread']), name="3M-RRP (Micro)", line=dict(color='#FF00FF', dash='dot')),
+    ], layout=dict(height=500, **CHART_LAYOUT))
+
+@st.cache_resource(**FIGURE_CACHE)
+def make_credit_fig(credit_df, price_label):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_traces([
+        go.Scattergl(**lttb_xy(credit_df['HY_Spread']), name="HY Spread", fill='tozeroy', line=dict(color='rgba(148, 0, 211, 0.2)', width=0)),
+        go.Scattergl(**lttb_xy(credit_df['Delinq_Consumer']), name="Consumer Delinq", line=dict(color='#FF4500', width=3)),
+        go.Scattergl(**lttb_xy(credit_df['Stock_Price']), name=price_label, line=dict(color='#00FF7F', width=2, dash='dot')),
+    ], rows=[1, 1, 1], cols=[1, 1, 1], secondary_ys=[False, False, True])
+    fig.update_layout(height=600, **CHART_LAYOUT)
+    return fig
+
+# --- 6. 主邏輯 ---
 if api_key_input:
     with st.spinner('正在同步數據...'):
-        df_macro = get_macro_data(api_key_input, data_fetch_days)
-    
+        # UI 呼叫不放在快取函式內，交由呼叫端顯示錯誤
+        try:
+            df_macro, macro_warning = get_macro_data(api_key_input, data_fetch_days)
+        except Exception as e:
+            st.error(f"數據抓取錯誤: {e}"); st.stop()
+    if macro_warning:
+        st.warning(macro_warning)
+
     if df_macro is not None:
-        stock_series = get_stock_data(compare_index, df_macro.index[0].strftime('%Y-%m-%d'))
+        with st.spinner('正在下載股價...'):
+            try:
+                # inner join 會把股價對齊到 df_macro 的日期區間，不必依滑桿切起始日
+                stock_series = get_stock_data(symbol, STOCK_HISTORY_START)
+            except Exception as e:
+                st.error(f"股價下載錯誤: {e}")
+                stock_series = None
         if stock_series is not None:
-            merged_df = pd.concat([df_macro, stock_series], axis=1).dropna()
-            merged_df.columns = list(df_macro.columns) + ['Stock_Price']
-            
+            try:
+                # validate 順便擋下重複日期 (資料源異常時 join 會悄悄放大列數)
+                merged_df = df_macro.join(stock_series.rename('Stock_Price'), how='inner', sort=False, validate='one_to_one')
+            except pd.errors.MergeError as e:
+                st.error(f"日期索引重複: {e}"); st.stop()
+
+            # 🟢 數據平滑化與模型計算
+            merged_df['Net_Liquidity_Smooth'] = rolling_mean(merged_df['Net_Liquidity'].to_numpy(), 7)
+            # 排序過的 DatetimeIndex 用 label slice：二分搜尋 + view，不建布林 mask
+            train_data = merged_df.loc[f"{reg_start_year}-01-01":, ['Net_Liquidity_Smooth', 'Stock_Price']].dropna()
+            fit = fit_fair_value(train_data)
+            plot_df = merged_df.loc[f"{display_start_year}-01-01":]
+            if fit is not None:
+                slope, intercept, r_squared = fit
+                # 公允價值只算顯示區間；頂部指標另外用最後一筆算
+                fair = plot_df['Net_Liquidity_Smooth'].to_numpy() * slope + intercept
+                fair_value = pd.Series(fair, index=plot_df.index)
+                deviation_pct = pd.Series((plot_df['Stock_Price'].to_numpy() - fair) / fair * 100, index=plot_df.index)
+                latest_fair = merged_df['Net_Liquidity_Smooth'].iat[-1] * slope + intercept
+                latest_dev = (merged_df['Stock_Price'].iat[-1] - latest_fair) / latest_fair * 100
+
+            # 只渲染目前選取的頁面 (st.tabs 每次 rerun 會把所有分頁都算一遍)
+            view = st.radio("檢視", ["💧 流動性估值", "📉 殖利率曲線", "☢️ VPIN", "🏦 違約監控"], horizontal=True, key='view', label_visibility="collapsed")
+
             # --- Tab 1: 流動性估值 ---
-            tab1, tab2, tab3, tab4 = st.tabs(["💧 流動性估值", "📉 殖利率曲線", "☢️ VPIN", "🏦 違約監控"])
-
-            with tab1:
-                st.subheader(f"美元淨流動性 vs {compare_index.split(' ')[0]}")
-                
-                # 🟢 數據平滑化與模型計算
-                merged_df['Net_Liquidity_Smooth'] = merged_df['Net_Liquidity'].rolling(window=7).mean()
-                train_data = merged_df[merged_df.index >= f"{reg_start_year}-01-01"].dropna()
-                
-                if len(train_data) > 30:
-                    x = train_data['Net_Liquidity_Smooth']
-                    y = train_data['Stock_Price']
-                    slope, intercept = np.polyfit(x, y, 1)
-                    r_squared = np.corrcoef(x, y)[0,1]**2
-                    
-                    merged_df['Fair_Value'] = merged_df['Net_Liquidity_Smooth'] * slope + intercept
-                    merged_df['Deviation_Pct'] = ((merged_df['Stock_Price'] - merged_df['Fair_Value']) / merged_df['Fair_Value']) * 100
-                    
-                    latest = merged_df.iloc[-1]
-                    plot_df = merged_df[merged_df.index >= f"{display_start_year}-01-01"]
+            if view == "💧 流動性估值":
+                st.subheader(f"美元淨流動性 vs {symbol}")
 
+                if fit is not None:
                     # 1. 頂部核心指標
                     c1, c2, c3, c4 = st.columns(4)
-                    c1.metric("淨流動性", f"${latest['Net_Liquidity']:.2f} T")
-                    c2.metric("公允股價", f"{latest['Fair_Value']:.0f}")
-                    c3.metric("溢價率", f"{latest['Deviation_Pct']:.1f}%", delta_color="inverse")
+                    c1.metric("淨流動性", f"${merged_df['Net_Liquidity'].iat[-1]:.2f} T")
+                    c2.metric("公允股價", f"{latest_fair:.0f}")
+                    c3.metric("溢價率", f"{latest_dev:.1f}%", delta_color="inverse")
                     c4.metric("模型解釋力 R²", f"{r_squared:.1%}")
 
                     # 2. 🟢 新增：單獨的流動性組成拆解圖
                     st.markdown("#### 🌊 流動性組成拆解 (Fed Assets - TGA - RRP)")
-                    fig_liq = go.Figure()
-                    fig_liq.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Net_Liquidity'], name="Net Liquidity", line=dict(color='#00FF00', width=3)))
-                    fig_liq.add_trace(go.Scatter(x=plot_df.index, y=plot_df['TGA']/1000000, name="TGA (Freezer)", line=dict(color='#FF4136', width=1, dash='dot')))
-                    fig_liq.add_trace(go.Scatter(x=plot_df.index, y=plot_df['RRP']/1000, name="RRP (Water Tank)", line=dict(color='#FFA500', width=1, dash='dash')))
-                    fig_liq.update_layout(height=350, template="plotly_dark", margin=dict(t=20, b=20), hovermode="x unified")
-                    st.plotly_chart(fig_liq, use_container_width=True)
+                    show_chart(make_liquidity_fig(plot_df[['Net_Liquidity', 'TGA', 'RRP']]))
 
                     st.divider()
 
                     # 3. 股價 vs 公允價值圖
                     st.markdown(f"#### ⚖️ 市場估值偏差分析 (Training Start: {reg_start_year})")
-                    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.7, 0.3])
-                    fig.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Stock_Price'], name="Price", line=dict(color='#FFA500')), row=1, col=1)
-                    fig.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Fair_Value'], name="Fair Value", line=dict(color='#1E90FF', dash='dash')), row=1, col=1)
-                    fig.add_trace(go.Bar(x=plot_df.index, y=plot_df['Deviation_Pct'], name="Bubble %", marker_color=np.where(plot_df['Deviation_Pct']>0, 'red', 'green')), row=2, col=1)
-                    fig.update_layout(height=600, template="plotly_dark", hovermode="x unified")
-                    st.plotly_chart(fig, use_container_width=True)
-
-            with tab2:
+                    show_chart(make_valuation_fig(plot_df['Stock_Price'], fair_value, deviation_pct, symbol_label))
+
+            elif view == "📉 殖利率曲線":
                 st.subheader("雙重利差監控")
-                fig_yc = go.Figure()
-                fig_yc.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Yield_Curve'], name="10Y-3M (Macro)", line=dict(color='#00FFFF')))
-                fig_yc.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Arb_Spread'], name="3M-RRP (Micro)", line=dict(color='#FF00FF', dash='dot')))
-                fig_yc.update_layout(height=500, template="plotly_dark"); st.plotly_chart(fig_yc, use_container_width=True)
+                show_chart(make_yield_curve_fig(plot_df[['Yield_Curve', 'Arb_Spread']]))
 
-            with tab4:
+            elif view == "🏦 違約監控":
                 st.subheader("🏦 信貸違約雙戰場")
-                fig_battle = make_subplots(specs=[[{"secondary_y": True}]])
-                fig_battle.add_trace(go.Scatter(x=plot_df.index, y=plot_df['HY_Spread'], name="HY Spread", fill='tozeroy', line=dict(color='rgba(148, 0, 211, 0.2)', width=0)), secondary_y=False)
-                fig_battle.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Delinq_Consumer'], name="Consumer Delinq", line=dict(color='#FF4500', width=3)), secondary_y=False)
-                fig_battle.add_trace(go.Scatter(x=plot_df.index, y=plot_df['Stock_Price'], name="Price", line=dict(color='#00FF7F', width=2, dash='dot')), secondary_y=True)
-                fig_battle.update_layout(height=600, template="plotly_dark"); st.plotly_chart(fig_battle, use_container_width=True)
+                show_chart(make_credit_fig(plot_df[['HY_Spread', 'Delinq_Consumer', 'Stock_Price']], symbol_label))
 else:
     st.info("👈 請在左側輸入 FRED API Key 以啟動")